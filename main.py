@@ -1,6 +1,11 @@
 import json
+import math
 import os
-from time import sleep
+import queue
+import struct
+import sys
+import threading
+import time
 
 from src.backend.DeckManagement.DeckController import DeckController
 from src.backend.PageManagement.Page import Page
@@ -9,38 +14,133 @@ from src.backend.PluginManager.ActionHolder import ActionHolder
 from src.backend.PluginManager.PluginBase import PluginBase
 
 from evdev import ecodes, UInput
-from gi.repository import Gtk
 from loguru import logger as log
 from PIL import Image
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 log.debug("Init HELLDIVERS 2")
 
 
 SLEEP_DELAY = 0.03
 
+# struct input_event from linux/input.h, split into its timeval and the
+# type/code/value body so prebuilt bodies can be stamped just before writing.
+_TIMEVAL = struct.Struct("ll")
+_EVENT_BODY = struct.Struct("HHi")
+_SYN_EVENT = _EVENT_BODY.pack(ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+
+
+def _key_event(code, value):
+    return _EVENT_BODY.pack(ecodes.EV_KEY, code, value)
+
+
+# Events written together with a single SYN_REPORT reach the game as one frame
+def _frame(*events):
+    return events + (_SYN_EVENT,)
+
+
+# Left Control goes out in the same frame as the first key-down and the last
+# key-up, rather than in frames of its own
+_ACTIVATOR_DOWN = _key_event(ecodes.KEY_LEFTCTRL, 1)
+_ACTIVATOR_UP = _key_event(ecodes.KEY_LEFTCTRL, 0)
+
+
+# Flatten a stratagem into the exact frames to write, one per key edge,
+# so playback is nothing but write + sleep. Each frame is paired with the
+# release frame for whatever is still held once it has been written, or None.
+def _build_playback(codes, hero_mode):
+    frames = []
+    for code in codes:
+        frames.append([_key_event(code, 1)])
+        frames.append([_key_event(code, 0)])
+    if frames and not hero_mode:
+        frames[0].insert(0, _ACTIVATOR_DOWN)
+        frames[-1].append(_ACTIVATOR_UP)
+
+    playback = []
+    for i, events in enumerate(frames):
+        held = []
+        if i % 2 == 0:
+            held.append(_key_event(codes[i // 2], 0))
+        if not hero_mode and i < len(frames) - 1:
+            held.append(_ACTIVATOR_UP)
+        playback.append((_frame(*events), _frame(*held) if held else None))
+    return tuple(playback)
+
+
+# uinput accepts caller supplied CLOCK_MONOTONIC timestamps (and falls back to
+# its own clock for ones in the future or older than a few seconds), so frames
+# carry their planned time rather than whenever the write happened to land.
+def _stamp_frame(frame, timestamp):
+    sec = int(timestamp)
+    stamp = _TIMEVAL.pack(sec, int((timestamp - sec) * 1000000))
+    return stamp + stamp.join(frame)
+
+
+# Running estimate of how far time.sleep() overshoots, used by _sleep_until
+_sleep_overshoot_mean = 0.0
+_sleep_overshoot_m2 = 0.0
+_SLEEP_EMA_ALPHA = 0.1
+# A single stall (load, suspend) must not inflate the estimate, and the spin
+# holds the GIL, so both the samples and the spin window are capped
+_MAX_OVERSHOOT_SAMPLE = 0.002
+_MAX_SPIN = 0.002
+
+
+# time.sleep() routinely overshoots by a few ms, so sleep short of the deadline
+# by the expected overshoot and spin out the remainder. Deadlines are absolute
+# time.monotonic() values so jitter does not accumulate across a sequence.
+def _sleep_until(deadline):
+    global _sleep_overshoot_mean, _sleep_overshoot_m2
+    spin = min(_sleep_overshoot_mean + math.sqrt(_sleep_overshoot_m2), _MAX_SPIN)
+    coarse = deadline - time.monotonic() - spin
+    if coarse > 0:
+        start = time.monotonic()
+        time.sleep(coarse)
+        overshoot = min(time.monotonic() - start - coarse, _MAX_OVERSHOOT_SAMPLE)
+        delta = overshoot - _sleep_overshoot_mean
+        _sleep_overshoot_mean += _SLEEP_EMA_ALPHA * delta
+        _sleep_overshoot_m2 = (1 - _SLEEP_EMA_ALPHA) * (_sleep_overshoot_m2 + _SLEEP_EMA_ALPHA * delta * delta)
+    while time.monotonic() < deadline:
+        pass
+
 
 class StratagemHeroButton(ActionBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        lm = self.plugin_base.lm
+        self.top_label = lm.get("actions.StratagemHeroToggle.labels.top", "")
+        self.center_label = lm.get("actions.StratagemHeroToggle.labels.center", "Stratagem")
+        self.bottom_label = lm.get("actions.StratagemHeroToggle.labels.bottom", "Hero")
+        self.icon_off = self.plugin_base.icons.get("hero_off")
+        self.icon_on = self.plugin_base.icons.get("hero_on")
+
     def on_ready(self):
         self.show()
 
     def on_key_down(self):
         self.plugin_base.hero_mode = not self.plugin_base.hero_mode
-        self.show()
+        # Only the icon depends on hero_mode, the labels are already on the key
+        self.show_media()
 
     def show(self):
-        self.set_top_label(self.plugin_base.lm.get("actions.StratagemHeroToggle.labels.top", ""))
-        self.set_center_label(self.plugin_base.lm.get("actions.StratagemHeroToggle.labels.center", "Stratagem"))
-        self.set_bottom_label(self.plugin_base.lm.get("actions.StratagemHeroToggle.labels.bottom", "Hero"))
+        self.set_top_label(self.top_label)
+        self.set_center_label(self.center_label)
+        self.set_bottom_label(self.bottom_label)
+        self.show_media()
 
-        fname = "hero_off.png"
+    def show_media(self):
+        icon = self.icon_off
         if self.plugin_base.hero_mode:
-            fname = "hero_on.png"
+            icon = self.icon_on
         self.set_media(
-            media_path=os.path.join(self.plugin_base.PATH, "assets", "icons", fname),
+            image=icon,
             size=1.00,
             valign=-1
         )
@@ -52,13 +152,24 @@ class StratagemButton(ActionBase):
         
         self.stratagem_key = self.action_id.split("::", 1)[1]
         self.stratagem = self.plugin_base.stratagems[self.stratagem_key]
+        self.stratagem_codes = self.plugin_base.stratagem_codes[self.stratagem_key]
+        self.playback = {
+            hero_mode: _build_playback(self.stratagem_codes, hero_mode)
+            for hero_mode in (False, True)
+        }
+
+        lm = self.plugin_base.lm
+        self.top_label = lm.get(f"actions.{self.stratagem_key}.labels.top", "")
+        self.center_label = lm.get(f"actions.{self.stratagem_key}.labels.center", "")
+        self.bottom_label = lm.get(f"actions.{self.stratagem_key}.labels.bottom", lm.get(f"actions.{self.stratagem_key}.name"))
+        self.icon = self.plugin_base.icons.get(self.stratagem_key)
 
     def show(self):
-        self.set_top_label(self.plugin_base.lm.get(f"actions.{self.stratagem_key}.labels.top", ""))
-        self.set_center_label(self.plugin_base.lm.get(f"actions.{self.stratagem_key}.labels.center", ""))
-        self.set_bottom_label(self.plugin_base.lm.get(f"actions.{self.stratagem_key}.labels.bottom", self.plugin_base.lm.get(f"actions.{self.stratagem_key}.name")))
+        self.set_top_label(self.top_label)
+        self.set_center_label(self.center_label)
+        self.set_bottom_label(self.bottom_label)
         self.set_media(
-            media_path=os.path.join(self.plugin_base.PATH, "assets", "icons", self.stratagem_key + ".png"),
+            image=self.icon,
             size=1.00,
             valign=-1
         )
@@ -68,47 +179,45 @@ class StratagemButton(ActionBase):
         self.show()
 
     def on_key_down(self):
-        if self.plugin_base.executing:
+        if not self.plugin_base.execute_lock.acquire(blocking=False):
             log.debug("Currently executing other stratagem! Aborting!")
             return
-        self.plugin_base.executing = True
-        log.debug(f"Execute Stratagem: {self.stratagem_key}: {self.stratagem}")
-        if not self.plugin_base.hero_mode:
-            log.debug("Not Heroing")
-            self.plugin_base.ui.write(ecodes.EV_KEY, ecodes.KEY_LEFTCTRL, 1)
-            self.plugin_base.ui.syn()
-            sleep(SLEEP_DELAY)
-        try:
-            for key in self.stratagem:
-                self.plugin_base.ui.write(ecodes.EV_KEY, ecodes.ecodes[f"KEY_{key}"], 1)
-                self.plugin_base.ui.syn()
-                sleep(SLEEP_DELAY)
-                self.plugin_base.ui.write(ecodes.EV_KEY, ecodes.ecodes[f"KEY_{key}"], 0)
-                self.plugin_base.ui.syn()
-                sleep(SLEEP_DELAY)
-        finally:
-            self.plugin_base.ui.write(ecodes.EV_KEY, ecodes.KEY_LEFTCTRL, 0)
-            self.plugin_base.ui.syn()
-            sleep(SLEEP_DELAY)
-            self.plugin_base.executing = False
+        hero_mode = self.plugin_base.hero_mode
+        log.debug(f"Execute Stratagem: {self.stratagem_key}: {self.stratagem} (hero mode: {hero_mode})")
+        # Holding execute_lock means the single queue slot is free, so this never blocks
+        self.plugin_base.play_queue.put(self.playback[hero_mode])
 
 
 class HellDiversPlugin(PluginBase):
     def __init__(self):
         super().__init__()
 
+        self.icon_dir = os.path.join(self.PATH, "assets", "icons") + os.sep
+
         self.init_locale_manager()
         self.lm = self.locale_manager
         
-        self.ui = None
-        self.init_input()
-
         self.stratagems = None
+        self.stratagem_codes = None
         self.init_stratagems()
 
+        self.icons = None
+        self.init_icons()
+
+        self.ui = None
+        self.init_input()
+
         self.hero_mode = False
 
-        self.executing = False
+        # Held from the key press until playback finishes, released by the worker
+        self.execute_lock = threading.Lock()
+        self.next_start = 0.0
+
+        # Playback runs on its own thread so on_key_down returns immediately.
+        # execute_lock already drops presses during playback, so one slot is enough.
+        self.play_queue = queue.Queue(maxsize=1)
+        self.playback_thread = threading.Thread(target=self.playback_worker, daemon=True)
+        self.playback_thread.start()
 
         for stratagem in self.stratagems:
             try:
@@ -142,13 +251,83 @@ class HellDiversPlugin(PluginBase):
 
     def init_input(self):
         self.ui = None
+        # Advertise the keys the plugin can actually send, plus KEY_ESC..KEY_S
+        # (1-31) which udev requires to tag the device ID_INPUT_KEYBOARD
+        key_codes = set(range(1, 32))
+        key_codes.add(ecodes.KEY_LEFTCTRL)
+        for codes in self.stratagem_codes.values():
+            key_codes.update(codes)
         try:
-            self.ui = UInput({ecodes.EV_KEY: range(0, 300),
-                         ecodes.EV_REL: [ecodes.REL_X, ecodes.REL_Y]}, name="stream-controller-helldivers-2-plugin")
+            self.ui = UInput({ecodes.EV_KEY: sorted(key_codes)}, name="stream-controller-helldivers-2-plugin")
         except Exception as e:
             log.error(e)
 
     def init_stratagems(self):
-        with open(os.path.join(self.PATH, "assets", "data", "stratagems.json")) as f:
-            self.stratagems = json.load(f)
-        
+        path = os.path.join(self.PATH, "assets", "data", "stratagems.json")
+        if orjson is not None:
+            with open(path, "rb") as f:
+                data = orjson.loads(f.read())
+        else:
+            with open(path) as f:
+                data = json.load(f)
+
+        # Sequences are read-only and made of a handful of direction names,
+        # share one string object per direction across all of them. Keycodes
+        # are resolved here once, an unknown key only drops that stratagem.
+        self.stratagems = {}
+        self.stratagem_codes = {}
+        for stratagem, sequence in data.items():
+            try:
+                codes = tuple(ecodes.ecodes[f"KEY_{key}"] for key in sequence)
+            except KeyError as e:
+                log.error(f"Skipping stratagem {stratagem}: unknown key {e}")
+                continue
+            self.stratagems[stratagem] = tuple(sys.intern(key) for key in sequence)
+            self.stratagem_codes[stratagem] = codes
+
+    def init_icons(self):
+        # Decode every icon once up front instead of on each redraw
+        self.icons = {}
+        for name in [*self.stratagems, "hero_off", "hero_on"]:
+            try:
+                with Image.open(self.icon_dir + name + ".png") as image:
+                    self.icons[name] = image.copy()
+            except Exception as e:
+                log.error(e)
+
+    def playback_worker(self):
+        while True:
+            frames = self.play_queue.get()
+            try:
+                self.play_stratagem(frames)
+            except Exception as e:
+                log.error(e)
+            finally:
+                self.execute_lock.release()
+
+    def play_stratagem(self, frames):
+        # Sleeping before each frame also covers the gap the previous sequence
+        # left for Left Control to register as released
+        deadline = max(time.monotonic(), self.next_start)
+        fd = self.ui.fd
+        write = os.write
+        stamp_frame = _stamp_frame
+        sleep_until = _sleep_until
+        release = None
+        try:
+            for frame, held in frames:
+                sleep_until(deadline)
+                write(fd, stamp_frame(frame, deadline))
+                release = held
+                deadline += SLEEP_DELAY
+        except BaseException:
+            # Never leave a key held down. If the fd itself is broken this
+            # write fails too, so keep the original error as the one raised.
+            if release is not None:
+                try:
+                    write(fd, stamp_frame(release, time.monotonic()))
+                except OSError as e:
+                    log.error(e)
+            raise
+        finally:
+            self.next_start = deadline